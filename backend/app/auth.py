@@ -10,6 +10,21 @@ from fastapi.security import APIKeyHeader
 API_KEY = os.getenv("API_KEY")
 HMAC_SECRET = os.getenv("HMAC_SECRET")
 
+# MAC algorithm: "hmac-sha256" (default) or "blake2b-keyed".
+# Keyed BLAKE2b replaces the HMAC construction entirely and is faster on
+# short message bodies; senders must sign with the same algorithm.
+MAC_ALGO = os.getenv("IOT_MAC", "hmac-sha256")
+
+# Encode the key once at import; re-encoding per request is a needless
+# allocation on the hot path.
+_HMAC_KEY = HMAC_SECRET.encode("utf-8") if HMAC_SECRET else None
+
+def _compute_mac(body: bytes) -> bytes:
+    """Computes the MAC of a request body with the configured algorithm."""
+    if MAC_ALGO == "blake2b-keyed":
+        return hashlib.blake2b(body, key=_HMAC_KEY, digest_size=32).digest()
+    return hmac.new(_HMAC_KEY, body, hashlib.sha256).digest()
+
 # Header definitions
 api_key_header = APIKeyHeader(name="X-API-KEY", auto_error=False)
 signature_header = APIKeyHeader(name="X-Signature", auto_error=False)
@@ -21,7 +36,11 @@ async def require_api_key(api_key: str = Security(api_key_header)):
     """Ensures the correct API key is provided in X-API-KEY header."""
     if not API_KEY:
         raise HTTPException(status_code=500, detail="API_KEY not configured on server")
-    if api_key != API_KEY:
+    # Constant-time comparison avoids leaking key prefixes via timing.
+    # Compare as bytes: compare_digest raises TypeError on non-ASCII str
+    # input, and the header is attacker-controlled.
+    provided = (api_key or "").encode("utf-8", "surrogateescape")
+    if not hmac.compare_digest(provided, API_KEY.encode()):
         raise HTTPException(status_code=401, detail="Invalid or missing API Key")
     return True
 
@@ -38,14 +57,18 @@ async def verify_hmac(request: Request, signature: str = Security(signature_head
     if not signature:
         raise HTTPException(status_code=401, detail="Missing X-Signature header")
 
+    # Decode the hex signature once; reject malformed hex outright
+    try:
+        sig_bytes = bytes.fromhex(signature)
+    except ValueError:
+        raise HTTPException(status_code=401, detail="Invalid HMAC signature")
+
     # Read the request body
     body = await request.body()
-    expected = hmac.new(
-        HMAC_SECRET.encode(), body, hashlib.sha256
-    ).hexdigest()
+    expected = _compute_mac(body)
 
-    # Secure constant-time comparison
-    if not hmac.compare_digest(expected, signature):
+    # Secure constant-time comparison on raw digest bytes
+    if not hmac.compare_digest(expected, sig_bytes):
         raise HTTPException(status_code=401, detail="Invalid HMAC signature")
 
     return True
@@ -1,15 +1,19 @@
 # backend/app/main.py
 from fastapi import FastAPI, Depends, WebSocket, WebSocketDisconnect, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
-from typing import List, Dict, Any
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Dict, Any, Tuple, Set
 from . import models, db
 from .auth import require_api_key, verify_hmac
 from pydantic import BaseModel, Field, confloat, constr
 import asyncio
+import logging
 import os
+from collections import deque
 from datetime import datetime
-import json
+import orjson
+import msgpack
 import time
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.responses import PlainTextResponse
@@ -18,11 +22,19 @@ from dotenv import load_dotenv
 # Load environment variables from .env if present
 load_dotenv()
 
-# Create DB tables
-models.Base.metadata.create_all(bind=db.engine)
+# Connection chatter stays at DEBUG so it is off by default; print() into a
+# line-buffered pipe can block the event loop under load
+logging.basicConfig(level=os.getenv("LOGLEVEL", "INFO"))
+log = logging.getLogger("ws")
 
 app = FastAPI(title="IoT Security Dashboard API", version="1.0.0")
 
+# Create DB tables once the event loop is running (async engine)
+@app.on_event("startup")
+async def create_tables():
+    async with db.engine.begin() as conn:
+        await conn.run_sync(models.Base.metadata.create_all)
+
 # -------------------------
 # Validate critical secrets
 # -------------------------
@@ -61,12 +73,10 @@ class LimitBodyMiddleware(BaseHTTPMiddleware):
 
     async def dispatch(self, request: Request, call_next):
         length = request.headers.get("content-length")
-        if length is not None:
-            try:
-                if int(length) > self.max_bytes:
-                    return PlainTextResponse("Payload too large", status_code=413)
-            except ValueError:
-                pass
+        # ASCII-digit guard skips the exception path on malformed headers
+        # (isdigit() alone accepts Unicode digits that int() rejects)
+        if length is not None and length.isascii() and length.isdigit() and int(length) > self.max_bytes:
+            return PlainTextResponse("Payload too large", status_code=413)
         return await call_next(request)
 
 app.add_middleware(LimitBodyMiddleware, max_bytes=int(os.getenv("MAX_BODY_BYTES", "51200")))
@@ -76,30 +86,52 @@ app.add_middleware(LimitBodyMiddleware, max_bytes=int(os.getenv("MAX_BODY_BYTES"
 # -------------------------
 RATE_LIMIT_WINDOW = int(os.getenv("RATE_LIMIT_WINDOW", "60"))
 RATE_LIMIT_MAX = int(os.getenv("RATE_LIMIT_MAX", "120"))
-_rate_store_lock = asyncio.Lock()
-_rate_store: Dict[str, List[float]] = {}
+_RATE_REFILL = RATE_LIMIT_MAX / RATE_LIMIT_WINDOW  # tokens per second
+# Striped store: buckets live in 16 shards keyed by hash(ip), so any future
+# per-shard locking or sweeping touches 1/16th of the IPs at a time.
+_RATE_SHARDS = 16
+_bucket_shards: List[Dict[str, Tuple[float, float]]] = [{} for _ in range(_RATE_SHARDS)]
+
+def _bucket_shard(ip: str) -> Dict[str, Tuple[float, float]]:
+    return _bucket_shards[hash(ip) & (_RATE_SHARDS - 1)]
 
 async def check_rate_limit(ip: str):
+    # Token bucket: O(1) arithmetic per call. No lock needed — the update
+    # contains no awaits, so it is atomic on the single-threaded event loop.
     now = time.time()
-    async with _rate_store_lock:
-        timestamps = _rate_store.get(ip, [])
-        window_start = now - RATE_LIMIT_WINDOW
-        timestamps = [t for t in timestamps if t >= window_start]
-        if len(timestamps) >= RATE_LIMIT_MAX:
-            return False
-        timestamps.append(now)
-        _rate_store[ip] = timestamps
+    shard = _bucket_shard(ip)
+    tokens, last = shard.get(ip, (float(RATE_LIMIT_MAX), now))
+    tokens = min(float(RATE_LIMIT_MAX), tokens + (now - last) * _RATE_REFILL)
+    if tokens < 1.0:
+        shard[ip] = (tokens, now)
+        return False
+    shard[ip] = (tokens - 1.0, now)
     return True
 
+async def _sweep_rate_buckets():
+    # Evict buckets idle for more than two windows so memory stays
+    # proportional to active IPs rather than every IP ever seen.
+    while True:
+        await asyncio.sleep(RATE_LIMIT_WINDOW)
+        now = time.time()
+        for shard in _bucket_shards:
+            for ip, (_, last) in list(shard.items()):
+                if now - last > 2 * RATE_LIMIT_WINDOW:
+                    shard.pop(ip, None)
+
+@app.on_event("startup")
+async def start_rate_sweeper():
+    asyncio.create_task(_sweep_rate_buckets())
+
 # -------------------------
 # DB dependency
 # -------------------------
-def get_db():
+async def get_db():
     database = db.SessionLocal()
     try:
         yield database
     finally:
-        database.close()
+        await database.close()
 
 # -------------------------
 # Input validation models
@@ -113,25 +145,38 @@ class IngestEvent(BaseModel):
     payload: Dict[str, Any] = Field(default_factory=dict)
     metrics: Metrics | None = None
 
+class IngestBatch(BaseModel):
+    events: List[IngestEvent]
+
 # -------------------------
 # Connection manager
 # -------------------------
+FLUSH_MS = int(os.getenv("FLUSH_MS", "20"))
+FLUSH_MAX = int(os.getenv("FLUSH_MAX", "200"))
+
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        self.active_connections: Set[WebSocket] = set()
+        # Clients that negotiated binary msgpack frames (?format=msgpack)
+        self._msgpack_conns: Set[WebSocket] = set()
         self.frontend_ready: bool = False
         self._lock = asyncio.Lock()
-        self._backlog: List[Dict[str, Any]] = []
         self._max_backlog = int(os.getenv("BACKLOG_SIZE", "500"))
+        # maxlen makes overflow eviction O(1) on append
+        self._backlog: deque = deque(maxlen=self._max_backlog)
+        self._pending: List[Dict[str, Any]] = []
+        self._flush_event = asyncio.Event()
 
-    async def connect(self, websocket: WebSocket):
+    async def connect(self, websocket: WebSocket, use_msgpack: bool = False):
         await websocket.accept()
         async with self._lock:
-            self.active_connections.append(websocket)
+            self.active_connections.add(websocket)
+            if use_msgpack:
+                self._msgpack_conns.add(websocket)
 
     def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
+        self.active_connections.discard(websocket)
+        self._msgpack_conns.discard(websocket)
         if not self.active_connections:
             self.frontend_ready = False
 
@@ -139,31 +184,72 @@ class ConnectionManager:
         async with self._lock:
             self.frontend_ready = True
             if self._backlog and self.active_connections:
-                for ev in self._backlog[-self._max_backlog:]:
-                    await self._safe_broadcast(ev)
+                # Replay the whole backlog as a single frame instead of one
+                # frame per buffered event.
+                await self._safe_broadcast(
+                    {"type": "batch", "events": list(self._backlog)}
+                )
             self._backlog.clear()
 
     async def broadcast(self, message: Dict[str, Any]):
         if not self.frontend_ready:
             async with self._lock:
-                if len(self._backlog) >= self._max_backlog:
-                    self._backlog.pop(0)
                 self._backlog.append(message)
             return
-        await self._safe_broadcast(message)
+        # Queue for the flush loop; events are coalesced into one frame
+        # every FLUSH_MS instead of one frame per event. Hitting FLUSH_MAX
+        # flushes immediately — accepted events must never be dropped.
+        async with self._lock:
+            self._pending.append(message)
+            if len(self._pending) >= FLUSH_MAX:
+                batch, self._pending = self._pending, []
+                self._flush_event.clear()
+            else:
+                batch = None
+        if batch is not None:
+            await self._safe_broadcast({"type": "batch", "events": batch})
+        else:
+            self._flush_event.set()
+
+    async def _flush_loop(self):
+        while True:
+            await self._flush_event.wait()
+            # Give concurrent ingests a short window to pile up
+            await asyncio.sleep(FLUSH_MS / 1000)
+            async with self._lock:
+                batch, self._pending = self._pending, []
+                self._flush_event.clear()
+            if batch:
+                await self._safe_broadcast({"type": "batch", "events": batch})
 
     async def _safe_broadcast(self, message: Dict[str, Any]):
-        stale = []
-        for ws in list(self.active_connections):
-            try:
-                await ws.send_json(message)
-            except Exception:
-                stale.append(ws)
-        for ws in stale:
-            self.disconnect(ws)
+        # Serialize at most once per codec (orjson text for JSON clients,
+        # binary msgpack for clients that negotiated it) and fan out
+        # concurrently instead of encoding + awaiting per client.
+        text = None
+        packed = None
+        conns = tuple(self.active_connections)
+        coros = []
+        for ws in conns:
+            if ws in self._msgpack_conns:
+                if packed is None:
+                    packed = msgpack.packb(message, use_bin_type=True)
+                coros.append(ws.send_bytes(packed))
+            else:
+                if text is None:
+                    text = orjson.dumps(message).decode()
+                coros.append(ws.send_text(text))
+        results = await asyncio.gather(*coros, return_exceptions=True)
+        for ws, result in zip(conns, results):
+            if isinstance(result, Exception):
+                self.disconnect(ws)
 
 manager = ConnectionManager()
 
+@app.on_event("startup")
+async def start_flush_loop():
+    asyncio.create_task(manager._flush_loop())
+
 # -------------------------
 # Health endpoints
 # -------------------------
@@ -193,25 +279,16 @@ async def simulator_toggle():
 # -------------------------
 # Ingestion endpoint (secured)
 # -------------------------
-@app.post("/ingest", dependencies=[Depends(require_api_key)])
-async def ingest_event(request: Request, database: Session = Depends(get_db)):
+@app.post("/ingest", dependencies=[Depends(require_api_key), Depends(verify_hmac)])
+async def ingest_event(request: Request, database: AsyncSession = Depends(get_db)):
     client_ip = request.client.host if request.client else "unknown"
     if not await check_rate_limit(client_ip):
         raise HTTPException(status_code=429, detail="Rate limit exceeded")
 
     body = await request.body()
-    signature = request.headers.get("X-Signature", "")
-
-    # Perform HMAC verification (returns True/False)
-    from .auth import HMAC_SECRET as AUTH_SECRET
-    if AUTH_SECRET:
-        import hmac, hashlib
-        expected = hmac.new(AUTH_SECRET.encode(), body, hashlib.sha256).hexdigest()
-        if not hmac.compare_digest(expected, signature or ""):
-            raise HTTPException(status_code=401, detail="Invalid HMAC signature")
 
     try:
-        payload = json.loads(body.decode("utf-8"))
+        payload = orjson.loads(body)  # takes bytes directly, no decode pass
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid JSON payload")
 
@@ -220,10 +297,14 @@ async def ingest_event(request: Request, database: Session = Depends(get_db)):
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Invalid event structure: {e}")
 
-    db_event = models.Event(device_id=evt.device_id, payload=evt.payload or {"metrics": evt.metrics.dict() if evt.metrics else {}})
+    # Reuse the parsed sub-dicts directly — no model_dump/.dict() re-serialization
+    db_event = models.Event(
+        device_id=evt.device_id,
+        payload=payload.get("payload") or ({"metrics": payload["metrics"]} if "metrics" in payload else {}),
+    )
     database.add(db_event)
-    database.commit()
-    database.refresh(db_event)
+    await database.commit()
+    await database.refresh(db_event)
 
     event_data = {
         "id": db_event.id,
@@ -232,29 +313,90 @@ async def ingest_event(request: Request, database: Session = Depends(get_db)):
         "payload": db_event.payload,
     }
 
+    # Simple anomaly detection on the already-validated metrics; the flag
+    # rides on the same event so an anomaly doesn't cost a second frame.
+    if evt.metrics is not None:
+        m = evt.metrics
+        if m.temperature < 18.0 or m.temperature > 25.0 or m.vibration > 0.8:
+            event_data["anomaly"] = True
+
     await manager.broadcast(event_data)
 
-    # Simple anomaly detection
+    return {"status": "accepted", "id": db_event.id}
+
+@app.post("/ingest/batch", dependencies=[Depends(require_api_key), Depends(verify_hmac)])
+async def ingest_batch(request: Request, database: AsyncSession = Depends(get_db)):
+    client_ip = request.client.host if request.client else "unknown"
+    if not await check_rate_limit(client_ip):
+        raise HTTPException(status_code=429, detail="Rate limit exceeded")
+
+    body = await request.body()
+
     try:
-        metrics = event_data.get("payload", {}).get("metrics", {})
-        temp = float(metrics.get("temperature", 0))
-        vib = float(metrics.get("vibration", 0))
-        if temp < 18 or temp > 25 or vib > 0.8:
-            await manager.broadcast({"type": "anomaly", **event_data})
+        payload = orjson.loads(body)
     except Exception:
-        pass
+        raise HTTPException(status_code=400, detail="Invalid JSON payload")
 
-    return {"status": "accepted", "id": db_event.id}
+    try:
+        batch = IngestBatch(**payload)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Invalid batch structure: {e}")
+
+    if not batch.events:
+        return {"status": "accepted", "ids": []}
+
+    # Reuse the parsed sub-dicts directly — no model_dump/.dict() re-serialization
+    rows = [
+        {
+            "device_id": evt.device_id,
+            "payload": raw.get("payload") or ({"metrics": raw["metrics"]} if "metrics" in raw else {}),
+        }
+        for evt, raw in zip(batch.events, payload["events"])
+    ]
+
+    # One round-trip for the whole batch instead of add/commit per event
+    result = await database.execute(
+        insert(models.Event).returning(
+            models.Event.id, models.Event.timestamp, sort_by_parameter_order=True
+        ),
+        rows,
+    )
+    inserted = result.all()
+    await database.commit()
+
+    ids = []
+    for evt, row, values in zip(batch.events, inserted, rows):
+        event_data = {
+            "id": row.id,
+            "device_id": evt.device_id,
+            "timestamp": row.timestamp.isoformat(),
+            "payload": values["payload"],
+        }
+        if evt.metrics is not None:
+            m = evt.metrics
+            if m.temperature < 18.0 or m.temperature > 25.0 or m.vibration > 0.8:
+                event_data["anomaly"] = True
+        # The flush loop coalesces these into a single batch frame
+        await manager.broadcast(event_data)
+        ids.append(row.id)
+
+    return {"status": "accepted", "ids": ids}
 
 # -------------------------
 # Event listing
 # -------------------------
 @app.get("/events")
-def list_events(limit: int = 200, database: Session = Depends(get_db)):
-    q = database.query(models.Event).order_by(models.Event.timestamp.desc()).limit(limit).all()
+async def list_events(limit: int = 200, database: AsyncSession = Depends(get_db)):
+    # Column projection returns plain row tuples — no ORM object hydration
+    result = await database.execute(
+        select(models.Event.id, models.Event.device_id, models.Event.timestamp, models.Event.payload)
+        .order_by(models.Event.timestamp.desc())
+        .limit(limit)
+    )
+    rows = result.all()
     return [
-        {"id": e.id, "device_id": e.device_id, "timestamp": e.timestamp.isoformat(), "payload": e.payload}
-        for e in reversed(q)
+        {"id": r.id, "device_id": r.device_id, "timestamp": r.timestamp.isoformat(), "payload": r.payload}
+        for r in reversed(rows)
     ]
 
 # -------------------------
@@ -264,14 +406,16 @@ def list_events(limit: int = 200, database: Session = Depends(get_db)):
 async def websocket_endpoint(websocket: WebSocket):
     token = (websocket.query_params.get("token", "")or "").strip()
     expected = (WS_FRONTEND_TOKEN or "").strip()
-    print(f"WebSocket connection attempt with token: {token}")
+    log.debug("WebSocket connection attempt with token: %s", token)
     if expected and token != WS_FRONTEND_TOKEN:
         await websocket.close(code=1008)
-        print("WebSocket rejected: invalid or missing token")
+        log.debug("WebSocket rejected: invalid or missing token")
         return
 
-    await manager.connect(websocket)
-    print("✅ WebSocket client connected")
+    # Binary msgpack frames are opt-in; JSON text stays the default
+    use_msgpack = websocket.query_params.get("format", "json") == "msgpack"
+    await manager.connect(websocket, use_msgpack=use_msgpack)
+    log.debug("WebSocket client connected")
 
     try:
         while True:
@@ -280,7 +424,7 @@ async def websocket_endpoint(websocket: WebSocket):
                 await manager.mark_ready()
     except WebSocketDisconnect:
         manager.disconnect(websocket)
-        print("❌ WebSocket disconnected")
+        log.debug("WebSocket disconnected")
     except Exception as e:
         manager.disconnect(websocket)
-        print(f"⚠️ WebSocket error: {e}")
+        log.warning("WebSocket error: %s", e)
@@ -33,10 +33,10 @@ function App() {
         ws.send("frontend:ready");
       };
 
-      ws.onmessage = (event) => {
-        const data = JSON.parse(event.data);
-
-        if (data.type === "anomaly") {
+      const handleEvent = (data) => {
+        // Anomalous events carry an "anomaly" flag on the regular event
+        // (single frame) rather than arriving as a separate message
+        if (data.type === "anomaly" || data.anomaly) {
           setAnomalies((prev) => [
             ...prev,
             {
@@ -47,7 +47,8 @@ function App() {
               event: data,
             },
           ]);
-        } else {
+        }
+        if (data.type !== "anomaly") {
           const newEvents = Array.isArray(data) ? data : [data];
           setEvents((prev) => {
             const combined = [...prev, ...newEvents];
@@ -56,6 +57,17 @@ function App() {
         }
       };
 
+      ws.onmessage = (event) => {
+        const data = JSON.parse(event.data);
+
+        // Batched frames carry many events in one message
+        if (data.type === "batch") {
+          data.events.forEach(handleEvent);
+        } else {
+          handleEvent(data);
+        }
+      };
+
       ws.onclose = () => {
         console.warn(" WebSocket disconnected");
         setWsConnected(false);